@@ -3,6 +3,18 @@ import asyncio
 import logging
 import re
 import base64
+import functools
+import glob
+import hashlib
+import json
+import random
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict
 import requests
 from dotenv import load_dotenv
 # import uuid
@@ -11,6 +23,8 @@ from telegram.ext import (
     Application,
     MessageHandler,
     CommandHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
     ContextTypes,
 )
@@ -33,38 +47,842 @@ PIC_DIR = "pic"
 # Agent Zero API Settings
 AGENT_ZERO_URL = os.getenv("AGENT_ZERO_URL", "http://localhost:5000")
 AGENT_ZERO_API_KEY = os.getenv("AGENT_ZERO_API_KEY")  # Find this in Agent Zero Settings > External Services
+# Optional pool of several Agent Zero instances: comma-separated URLs and matching API keys
+# (a single key is used for every URL). Defaults to AGENT_ZERO_URL / AGENT_ZERO_API_KEY.
+AGENT_ZERO_URLS = [
+    url.strip()
+    for url in os.getenv("AGENT_ZERO_URLS", AGENT_ZERO_URL).split(",")
+    if url.strip()
+]
+AGENT_ZERO_API_KEYS = [
+    key.strip() for key in os.getenv("AGENT_ZERO_API_KEYS", "").split(",") if key.strip()
+]
+AGENT_ZERO_HEALTH_PATH = os.getenv("AGENT_ZERO_HEALTH_PATH", "/health")
+AGENT_ZERO_HEALTH_INTERVAL = float(os.getenv("AGENT_ZERO_HEALTH_INTERVAL", "30"))
+AGENT_ZERO_HEALTH_TIMEOUT = 5
+MAX_SESSION_BINDINGS = 1000
+# Updates this far below the last handled update_id are treated as a new sequence
+UPDATE_ID_WINDOW = 1000
+
+# Result history settings (local SQLite store used by /history and /search)
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "history.db")
+HISTORY_MAX_ENTRIES_PER_CHAT = int(os.getenv("HISTORY_MAX_ENTRIES_PER_CHAT", "1000"))
+HISTORY_MAX_AGE_DAYS = float(os.getenv("HISTORY_MAX_AGE_DAYS", "90"))
+HISTORY_MAX_DB_BYTES = int(os.getenv("HISTORY_MAX_DB_BYTES", str(50 * 1024 * 1024)))
+HISTORY_PREVIEW_CHARS = 300
+
+# Graceful shutdown settings (drain in-flight tasks, checkpoint the rest for the next start)
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "pending_tasks.json")
+UPDATE_STATE_PATH = os.getenv("UPDATE_STATE_PATH", "last_update_id.json")
+RESUME_INTERRUPTED_TASKS = os.getenv("RESUME_INTERRUPTED_TASKS", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+SCREENSHOT_GLOB = "action_*.png"
+
+# Profiling settings (opt-in monitoring; /debug tasks and /debug profile work regardless)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.1"))
+LOOP_LAG_WARN_SECONDS = float(os.getenv("LOOP_LAG_WARN_SECONDS", "0.25"))
+SLOW_CALLBACK_SECONDS = float(os.getenv("SLOW_CALLBACK_SECONDS", "0.1"))
+LOOP_LAG_INTERVAL = 0.5
+PROFILE_DIR = "profiles"
+PROFILE_SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 300
 
 # Ensure the pictures directory exists
 os.makedirs(PIC_DIR, exist_ok=True)
 context_id = None
 
 
+class HistoryStore:
+    """SQLite store of past prompts/responses per chat, with FTS5 search when available."""
+
+    def __init__(
+        self,
+        path,
+        max_entries_per_chat=HISTORY_MAX_ENTRIES_PER_CHAT,
+        max_age_days=HISTORY_MAX_AGE_DAYS,
+        max_db_bytes=HISTORY_MAX_DB_BYTES,
+    ):
+        self.path = path
+        self.max_entries_per_chat = max_entries_per_chat
+        self.max_age_days = max_age_days
+        self.max_db_bytes = max_db_bytes
+        self.has_fts = False
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Open lazily so importing the bot (e.g. in tests) does not create the database file
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                prompt TEXT NOT NULL,
+                response TEXT NOT NULL,
+                images TEXT NOT NULL DEFAULT '[]',
+                duration REAL NOT NULL DEFAULT 0,
+                is_scheduled INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_history_chat ON history (chat_id, created_at)"
+        )
+        try:
+            conn.execute(
+                """CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                    prompt, response, content='history', content_rowid='id'
+                )"""
+            )
+            # Keep the external-content FTS index in sync with the history table
+            conn.execute(
+                """CREATE TRIGGER IF NOT EXISTS history_ai AFTER INSERT ON history BEGIN
+                    INSERT INTO history_fts(rowid, prompt, response)
+                    VALUES (new.id, new.prompt, new.response);
+                END"""
+            )
+            conn.execute(
+                """CREATE TRIGGER IF NOT EXISTS history_ad AFTER DELETE ON history BEGIN
+                    INSERT INTO history_fts(history_fts, rowid, prompt, response)
+                    VALUES ('delete', old.id, old.prompt, old.response);
+                END"""
+            )
+            self.has_fts = True
+        except sqlite3.OperationalError as e:
+            logging.warning(f"SQLite FTS5 unavailable, falling back to LIKE search: {e}")
+        conn.commit()
+        self._conn = conn
+        return conn
+
+    def add(
+        self, chat_id, prompt, response, images=None, duration=0.0, is_scheduled=False
+    ):
+        """Stores one completed task and enforces the retention limits."""
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            cursor = conn.execute(
+                """INSERT INTO history
+                    (chat_id, created_at, prompt, response, images, duration, is_scheduled)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    chat_id,
+                    now,
+                    prompt,
+                    response,
+                    json.dumps(images or []),
+                    duration,
+                    int(is_scheduled),
+                ),
+            )
+            self._apply_retention(conn, chat_id, now)
+            conn.commit()
+            self._compact_if_needed(conn)
+            return cursor.lastrowid
+
+    def _apply_retention(self, conn, chat_id, now):
+        if self.max_age_days > 0:
+            conn.execute(
+                "DELETE FROM history WHERE created_at < ?",
+                (now - self.max_age_days * 86400,),
+            )
+        if self.max_entries_per_chat > 0:
+            conn.execute(
+                """DELETE FROM history WHERE chat_id = ? AND id NOT IN (
+                    SELECT id FROM history WHERE chat_id = ?
+                    ORDER BY id DESC LIMIT ?
+                )""",
+                (chat_id, chat_id, self.max_entries_per_chat),
+            )
+
+    def _db_size(self, conn):
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def _compact_if_needed(self, conn):
+        """Drops the oldest quarter of entries until the database fits in max_db_bytes."""
+        if self.max_db_bytes <= 0 or self._db_size(conn) <= self.max_db_bytes:
+            return
+        while self._db_size(conn) > self.max_db_bytes:
+            total = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+            if total == 0:
+                break
+            conn.execute(
+                "DELETE FROM history WHERE id IN (SELECT id FROM history ORDER BY id LIMIT ?)",
+                (max(1, total // 4),),
+            )
+            if self.has_fts:
+                conn.execute("INSERT INTO history_fts(history_fts) VALUES ('optimize')")
+            conn.commit()
+            conn.execute("VACUUM")
+        logging.info(f"History compacted to {self._db_size(conn)} bytes.")
+
+    def recent(self, chat_id, limit=5):
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT * FROM history WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                (chat_id, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def search(self, chat_id, terms, limit=5):
+        """Returns the best matching entries for the given chat, all terms required."""
+        words = terms.split()
+        if not words:
+            return []
+        with self._lock:
+            conn = self._connect()
+            if self.has_fts:
+                # Quote every word so user input is never parsed as FTS5 query syntax
+                query = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+                rows = conn.execute(
+                    """SELECT history.* FROM history_fts
+                        JOIN history ON history.id = history_fts.rowid
+                        WHERE history_fts MATCH ? AND history.chat_id = ?
+                        ORDER BY bm25(history_fts) LIMIT ?""",
+                    (query, chat_id, limit),
+                ).fetchall()
+            else:
+                clauses = " AND ".join("(prompt || ' ' || response) LIKE ?" for _ in words)
+                rows = conn.execute(
+                    f"""SELECT * FROM history WHERE chat_id = ? AND {clauses}
+                        ORDER BY id DESC LIMIT ?""",
+                    (chat_id, *[f"%{word}%" for word in words], limit),
+                ).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+history_store = HistoryStore(HISTORY_DB_PATH)
+
+
+class Profiler:
+    """Event-loop lag monitoring, sampled handler timings and on-demand stack profiles."""
+
+    def __init__(self, enabled=PROFILING_ENABLED, sample_rate=PROFILE_SAMPLE_RATE):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.timings = {}  # name -> {"count", "total", "max", "last"}
+        self.loop_lag_last = 0.0
+        self.loop_lag_max = 0.0
+        self.capturing = False
+        self._lag_task = None
+        self._heartbeat = 0.0
+        self._loop_thread_id = None
+        self._watchdog = None
+        self._watchdog_stop = threading.Event()
+
+    def timed(self, name):
+        """Decorator recording the duration of a sample of calls to an async function."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled or random.random() >= self.sample_rate:
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.record(name, time.perf_counter() - started)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, name, duration):
+        stats = self.timings.setdefault(
+            name, {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+        )
+        stats["count"] += 1
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration)
+        stats["last"] = duration
+
+    def start(self):
+        if not self.enabled or self._lag_task is not None:
+            return
+        # Slow callbacks are caught by a watchdog thread rather than asyncio debug mode,
+        # which would slow down every callback and skew the numbers reported here
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.perf_counter()
+        self._watchdog_stop.clear()
+        self._lag_task = asyncio.create_task(self._monitor_loop_lag())
+        self._watchdog = threading.Thread(
+            target=self._watch_loop, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+        logging.info(f"Profiling enabled (sample rate {self.sample_rate}).")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            await asyncio.gather(self._lag_task, return_exceptions=True)
+            self._lag_task = None
+        if self._watchdog is not None:
+            self._watchdog_stop.set()
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+    async def _monitor_loop_lag(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self._heartbeat = time.perf_counter()
+            lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+            self.loop_lag_last = lag
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+            if lag > LOOP_LAG_WARN_SECONDS:
+                logging.warning(f"Event loop lag: {lag * 1000:.0f} ms")
+
+    def _watch_loop(self):
+        """Logs the loop thread's stack while a callback blocks it for too long."""
+        reported = None
+        while not self._watchdog_stop.wait(max(0.01, SLOW_CALLBACK_SECONDS / 2)):
+            heartbeat = self._heartbeat
+            blocked = time.perf_counter() - heartbeat - LOOP_LAG_INTERVAL
+            # Report each stall once, while the blocking code is still on the stack
+            if blocked <= SLOW_CALLBACK_SECONDS or reported == heartbeat:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                stack = "".join(traceback.format_stack(frame))
+                logging.warning(
+                    f"Event loop blocked for over {blocked * 1000:.0f} ms, loop thread stack:\n{stack}"
+                )
+
+    async def capture(self, seconds):
+        """Samples every thread's stack for the given time and writes a folded-stack file.
+
+        The output is the collapsed format read by flamegraph.pl, speedscope and inferno.
+        """
+        if self.capturing:
+            raise RuntimeError("A profile capture is already running.")
+        self.capturing = True
+        try:
+            counts = await asyncio.to_thread(self._sample_stacks, seconds)
+        finally:
+            self.capturing = False
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(
+            PROFILE_DIR, time.strftime("profile_%Y%m%d_%H%M%S.folded", time.localtime())
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def _sample_stacks(self, seconds):
+        counts = Counter()
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id not in names:
+                    names.update((t.ident, t.name) for t in threading.enumerate())
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+        return counts
+
+    def format_stats(self):
+        if not self.enabled:
+            return "Profiling is disabled. Set PROFILING_ENABLED=true to collect timings."
+        text = (
+            f"⏱ Event loop lag: last {self.loop_lag_last * 1000:.0f} ms, "
+            f"max {self.loop_lag_max * 1000:.0f} ms\n"
+            f"Handler timings (sample rate {self.sample_rate}):\n"
+        )
+        if not self.timings:
+            text += "• No samples yet.\n"
+        for name, stats in sorted(self.timings.items()):
+            average = stats["total"] / stats["count"]
+            text += (
+                f"• {name}: {stats['count']} samples, avg {average * 1000:.0f} ms, "
+                f"max {stats['max'] * 1000:.0f} ms, last {stats['last'] * 1000:.0f} ms\n"
+            )
+        return text
+
+
+profiler = Profiler()
+
+
+def format_pending_tasks():
+    """Describes every pending asyncio task and where it is currently suspended."""
+    tasks = [task for task in asyncio.all_tasks() if not task.done()]
+    text = f"🧵 {len(tasks)} pending asyncio tasks:\n"
+    for task in sorted(tasks, key=lambda t: t.get_name()):
+        coro = task.get_coro()
+        name = getattr(coro, "__qualname__", repr(coro))
+        location = ""
+        stack = task.get_stack(limit=1)
+        if stack:
+            frame = stack[-1]
+            location = f" at {os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}"
+        text += f"• {task.get_name()}: {name}{location}\n"
+    records = shutdown_coordinator.pending_records()
+    text += f"\n🚀 {len(records)} agent tasks in flight:\n"
+    now = time.time()
+    for record in records:
+        text += f"• chat {record['chat_id']} ({now - record['created_at']:.0f}s): {record['prompt']}\n"
+    return text
+
+
+def parse_duration(value):
+    """Parses '30', '30s' or '2m' into seconds."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([sm]?)", value.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid duration: {value}")
+    seconds = float(match.group(1))
+    return seconds * 60 if match.group(2) == "m" else seconds
+
+
+def cleanup_temp_files():
+    """Removes leftover browser screenshots (action_<chat_id>.png) from interrupted tasks."""
+    for path in glob.glob(SCREENSHOT_GLOB):
+        try:
+            os.remove(path)
+            logging.info(f"Removed temporary file {path}")
+        except OSError as e:
+            logging.error(f"Failed to remove temporary file {path}: {e}")
+
+
+class ShutdownCoordinator:
+    """Tracks in-flight agent tasks so a restart can drain, checkpoint and resume them."""
+
+    def __init__(self, checkpoint_path, drain_seconds=SHUTDOWN_DRAIN_SECONDS):
+        self.checkpoint_path = checkpoint_path
+        self.drain_seconds = drain_seconds
+        self.accepting = True
+        self._tasks = {}  # asyncio.Task -> checkpoint record
+        self._shutdown_task = None
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    def start_task(
+        self,
+        prompt,
+        chat_id,
+        context,
+        is_scheduled=False,
+        attachments=None,
+        session_id=None,
+    ):
+        """Starts process_agent_task in the background, or defers it while shutting down.
+
+        session_id continues that Agent Zero context instead of the current one.
+        Returns the created task, or None if the bot is no longer accepting work.
+        """
+        task_context_id = session_id or context_id
+        record = {
+            "prompt": prompt,
+            "chat_id": chat_id,
+            "is_scheduled": is_scheduled,
+            "attachments": attachments or [],
+            "context_id": task_context_id,
+            "backend_url": backend_pool.session_url(task_context_id),
+            "created_at": time.time(),
+        }
+        if not self.accepting:
+            # Scheduled runs are simply skipped, the next interval will pick them up again
+            if not is_scheduled:
+                self._append_checkpoint([record])
+                logging.info(f"Shutting down, deferred task for chat {chat_id}: {prompt}")
+            return None
+        # Write the record before the task runs, so even a crash leaves it for the next start
+        try:
+            self._append_checkpoint([record])
+        except OSError as e:
+            logging.error(f"Failed to checkpoint task for chat {chat_id}: {e}")
+        task = asyncio.create_task(
+            process_agent_task(
+                prompt, chat_id, context, is_scheduled, attachments, session_id
+            )
+        )
+        self._tasks[task] = record
+        task.add_done_callback(self._discard)
+        return task
+
+    def _discard(self, task):
+        record = self._tasks.pop(task, None)
+        # Cancelled tasks were interrupted by a shutdown and stay checkpointed
+        if record is not None and not task.cancelled():
+            try:
+                self._remove_from_checkpoint([record])
+            except OSError as e:
+                logging.error(f"Failed to update checkpoint: {e}")
+
+    def pending_records(self):
+        return list(self._tasks.values())
+
+    async def shutdown(self):
+        """Stops intake and drains in-flight tasks. Safe to call more than once."""
+        if self._shutdown_task is None:
+            self._shutdown_task = asyncio.ensure_future(self._drain())
+        await self._shutdown_task
+
+    async def _drain(self):
+        self.accepting = False
+        pending = set(self._tasks)
+        if pending:
+            logging.info(
+                f"Shutdown: waiting up to {self.drain_seconds}s for {len(pending)} in-flight tasks..."
+            )
+            _, pending = await asyncio.wait(pending, timeout=self.drain_seconds)
+        if pending:
+            # Their records were checkpointed by start_task and stay there once cancelled
+            records = [self._tasks[task] for task in pending if task in self._tasks]
+            # Requests still running on daemon threads are abandoned and die with the process
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            logging.warning(
+                f"Shutdown: checkpointed and cancelled {len(records)} unfinished tasks "
+                f"(saved to {self.checkpoint_path})."
+            )
+        else:
+            logging.info("Shutdown: all in-flight tasks finished.")
+        cleanup_temp_files()
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return []
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to read checkpoint {self.checkpoint_path}: {e}")
+            return []
+
+    def _append_checkpoint(self, records):
+        self._write_checkpoint(self._load_checkpoint() + records)
+
+    def _remove_from_checkpoint(self, records):
+        self._write_checkpoint(
+            [record for record in self._load_checkpoint() if record not in records]
+        )
+
+    def _write_checkpoint(self, records):
+        if not records:
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            return
+        # Write to a temporary file first so a crash never leaves a half-written checkpoint
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(records, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    async def resume(self, application):
+        """Resumes (or reports) tasks checkpointed by the previous run."""
+        global context_id
+        records = self._load_checkpoint()
+        if not records:
+            return
+        logging.info(f"Found {len(records)} tasks interrupted by the last shutdown.")
+        failed = []
+        last_session_id = None
+        for record in records:
+            chat_id = record["chat_id"]
+            prompt = record["prompt"]
+            # Continue the conversation the interrupted task belonged to. The context ID is
+            # passed to the task itself, since the global may change while we await below.
+            session_id = None
+            if record.get("context_id") and not record["is_scheduled"]:
+                session_id = last_session_id = record["context_id"]
+                if record.get("backend_url"):
+                    backend_pool.bind_url(session_id, record["backend_url"])
+            try:
+                if RESUME_INTERRUPTED_TASKS:
+                    await application.bot.send_message(
+                        chat_id=chat_id,
+                        text=f"♻️ Resuming task interrupted by a restart: '{prompt}'",
+                    )
+                    self.start_task(
+                        prompt,
+                        chat_id,
+                        ContextTypes.DEFAULT_TYPE(application, chat_id=chat_id),
+                        record["is_scheduled"],
+                        record["attachments"] or None,
+                        session_id,
+                    )
+                else:
+                    await application.bot.send_message(
+                        chat_id=chat_id,
+                        text=f"⚠️ Your task '{prompt}' was interrupted by a restart. Please send it again.",
+                    )
+            except Exception as e:
+                logging.error(f"Failed to resume interrupted task for chat {chat_id}: {e}")
+                failed.append(record)
+        # Keep only the records that could not be resumed or reported, for the next start.
+        # Resumed tasks have already checkpointed themselves again under new records.
+        self._remove_from_checkpoint([record for record in records if record not in failed])
+        if context_id is None and last_session_id:
+            context_id = last_session_id
+
+
+shutdown_coordinator = ShutdownCoordinator(CHECKPOINT_PATH)
+
+
+def format_history_entry(entry):
+    """Formats a history row as a short plain-text block for Telegram."""
+    timestamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["created_at"]))
+    kind = "⏰" if entry["is_scheduled"] else "💬"
+    response = entry["response"]
+    if len(response) > HISTORY_PREVIEW_CHARS:
+        response = response[:HISTORY_PREVIEW_CHARS] + "…"
+    text = f"{kind} {timestamp} ({entry['duration']:.1f}s)\nQ: {entry['prompt']}\nA: {response}\n"
+    images = json.loads(entry["images"])
+    if images:
+        text += "🖼 " + ", ".join(os.path.basename(path) for path in images) + "\n"
+    return text
+
+
+async def run_in_daemon_thread(func, *args, **kwargs):
+    """Like asyncio.to_thread, but on a daemon thread the interpreter does not wait for.
+
+    Cancelling the caller abandons the call, so a hanging Agent Zero request cannot keep
+    the process alive past the shutdown deadline.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def deliver(setter, value):
+        if not future.done():
+            setter(value)
+
+    def run():
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            callback = (deliver, future.set_exception, e)
+        else:
+            callback = (deliver, future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(*callback)
+        except RuntimeError:
+            pass  # The loop was closed while the call was running, nobody is waiting
+
+    threading.Thread(target=run, name="agent-zero-request", daemon=True).start()
+    return await future
+
+
+class Backend:
+    """One Agent Zero instance in the pool."""
+
+    def __init__(self, url, api_key=None):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.healthy = True  # Assume healthy until a check or request says otherwise
+        self.outstanding = 0
+
+    @property
+    def headers(self):
+        return {"Content-Type": "application/json", "X-API-KEY": self.api_key}
+
+    def __repr__(self):
+        return f"Backend({self.url}, healthy={self.healthy}, outstanding={self.outstanding})"
+
+
+class BackendPool:
+    """Routes requests to Agent Zero instances by least outstanding requests.
+
+    A context_id is bound to the instance that created it, so a conversation always
+    reaches the instance that owns it. Only requests without a session fail over.
+    """
+
+    def __init__(
+        self,
+        urls,
+        api_keys=None,
+        health_path=AGENT_ZERO_HEALTH_PATH,
+        health_interval=AGENT_ZERO_HEALTH_INTERVAL,
+    ):
+        api_keys = api_keys or [AGENT_ZERO_API_KEY]
+        self.backends = [
+            Backend(url, api_keys[i] if i < len(api_keys) else api_keys[0])
+            for i, url in enumerate(urls)
+        ]
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self._sessions = OrderedDict()  # context_id -> Backend
+        self._next = 0
+        self._health_task = None
+
+    def acquire(self, session_id=None, exclude=()):
+        """Picks the backend for a request, or None if every candidate was excluded."""
+        if session_id and session_id in self._sessions:
+            backend = self._sessions[session_id]
+            if not backend.healthy:
+                logging.warning(f"Session {session_id} is bound to unhealthy {backend.url}")
+            return None if backend in exclude else backend
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        # Fall back to every remaining backend if none passed its last health check
+        candidates = [b for b in candidates if b.healthy] or candidates
+        least = min(b.outstanding for b in candidates)
+        candidates = [b for b in candidates if b.outstanding == least]
+        # Rotate between equally loaded backends
+        self._next += 1
+        return candidates[self._next % len(candidates)]
+
+    def bind(self, session_id, backend):
+        self._sessions[session_id] = backend
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > MAX_SESSION_BINDINGS:
+            self._sessions.popitem(last=False)
+
+    def session_url(self, session_id):
+        backend = self._sessions.get(session_id)
+        return backend.url if backend else None
+
+    def bind_url(self, session_id, url):
+        for backend in self.backends:
+            if backend.url == url:
+                self.bind(session_id, backend)
+                return
+
+    def mark_unhealthy(self, backend, reason):
+        if backend.healthy:
+            logging.warning(f"Agent Zero backend {backend.url} marked unhealthy: {reason}")
+        backend.healthy = False
+
+    async def post(self, backend, path, payload, timeout=None):
+        """POSTs to a backend in a daemon thread, counting it as outstanding meanwhile."""
+        backend.outstanding += 1
+        try:
+            return await run_in_daemon_thread(
+                requests.post,
+                f"{backend.url}{path}",
+                json=payload,
+                headers=backend.headers,
+                timeout=timeout,
+            )
+        finally:
+            backend.outstanding -= 1
+
+    async def check_health(self):
+        """Probes every backend once; any non-5xx answer counts as healthy."""
+
+        async def check(backend):
+            try:
+                response = await asyncio.to_thread(
+                    requests.get,
+                    f"{backend.url}{self.health_path}",
+                    headers=backend.headers,
+                    timeout=AGENT_ZERO_HEALTH_TIMEOUT,
+                )
+                healthy = response.status_code < 500
+                reason = f"status {response.status_code}"
+            except requests.RequestException as e:
+                healthy, reason = False, e
+            if healthy and not backend.healthy:
+                logging.info(f"Agent Zero backend {backend.url} is healthy again.")
+            if healthy:
+                backend.healthy = True
+            else:
+                self.mark_unhealthy(backend, reason)
+
+        await asyncio.gather(*(check(backend) for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_interval)
+
+    def start_health_checks(self):
+        # A single backend is used regardless of its health, so there is nothing to check
+        if len(self.backends) > 1 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop_health_checks(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+
+
+backend_pool = BackendPool(AGENT_ZERO_URLS, AGENT_ZERO_API_KEYS)
+
+
 def reset_session():
     global context_id
     context_id = None
     logging.info("Session reset. Context ID cleared.")
 
 
+@profiler.timed("run_agent_sync")
 async def run_agent_sync(
-    prompt, is_scheduled=False, screenshot_path=None, attachments=None
+    prompt, is_scheduled=False, screenshot_path=None, attachments=None, session_id=None
 ):
+    """Sends a prompt to Agent Zero, continuing session_id or else the current context.
 
+    Returns (response text, downloaded image paths, ok). When ok is False the text is
+    a user-facing error message rather than an Agent Zero answer.
+    """
     global context_id
     try:
-        headers = {"Content-Type": "application/json", "X-API-KEY": AGENT_ZERO_API_KEY}
         payload = {"message": prompt, "lifetime_hours": 24}
         if attachments:
             payload["attachments"] = attachments
-        if context_id and not is_scheduled:
-            payload["context_id"] = context_id
-            logging.info(f"Sending request with context_id: {context_id}")
-        # Run the synchronous requests.post in a separate thread to avoid blocking the async event loop
-        response = await asyncio.to_thread(
-            requests.post,
-            f"{AGENT_ZERO_URL}/api_message",
-            json=payload,
-            headers=headers,
-        )
+        session_id = None if is_scheduled else session_id or context_id
+        if session_id:
+            payload["context_id"] = session_id
+            logging.info(f"Sending request with context_id: {session_id}")
+        tried = []
+        while True:
+            backend = backend_pool.acquire(session_id, exclude=tried)
+            tried.append(backend)
+            try:
+                # Run the synchronous requests.post in a separate thread to avoid blocking the async event loop
+                response = await backend_pool.post(backend, "/api_message", payload)
+            except requests.RequestException as e:
+                backend_pool.mark_unhealthy(backend, e)
+                # Sessions live on a single instance, only session-less requests can fail over
+                if session_id or backend_pool.acquire(exclude=tried) is None:
+                    raise
+                logging.warning(f"Failing over from {backend.url}: {e}")
+                continue
+            if (
+                response.status_code >= 500
+                and not session_id
+                and backend_pool.acquire(exclude=tried) is not None
+            ):
+                backend_pool.mark_unhealthy(backend, f"status {response.status_code}")
+                logging.warning(
+                    f"Failing over from {backend.url}: status {response.status_code}"
+                )
+                continue
+            break
         if response.status_code == 200:
             data = response.json()
             # LOG THE FULL RESPONSE TO SEE WHAT AGENT ZERO IS ACTUALLY SENDING
@@ -79,6 +897,7 @@ async def run_agent_sync(
                 )
                 if new_context_id:
                     context_id = new_context_id
+                    backend_pool.bind(new_context_id, backend)
                     logging.info(f"Updated context_id to: {context_id}")
                 else:
                     logging.warning(
@@ -97,11 +916,9 @@ async def run_agent_sync(
             if cleaned_paths:
                 logging.info(f"Found image paths in response: {cleaned_paths}")
                 try:
-                    files_response = await asyncio.to_thread(
-                        requests.post,
-                        f"{AGENT_ZERO_URL}/api_files_get",
-                        json={"paths": cleaned_paths},
-                        headers=headers,
+                    # Files live on the instance that produced the response
+                    files_response = await backend_pool.post(
+                        backend, "/api_files_get", {"paths": cleaned_paths}
                     )
                     if files_response.status_code == 200:
                         files_data = files_response.json()
@@ -129,11 +946,15 @@ async def run_agent_sync(
                     logging.error(f"Error fetching images from Agent Zero: {e}")
             # Remove the markdown image links from the text response so they don't show up as broken links in Telegram
             clean_bot_response = re.sub(r"!\[.*?\]\(.*?\)", "", bot_response).strip()
-            return clean_bot_response, downloaded_images
+            return clean_bot_response, downloaded_images, True
         else:
             error_msg = f"API Error {response.status_code}: {response.text}"
             logging.error(error_msg)
-            return f"I'm having trouble connecting to Agent Zero API. {error_msg}", []
+            return (
+                f"I'm having trouble connecting to Agent Zero API. {error_msg}",
+                [],
+                False,
+            )
 
     except Exception as e:
         error_msg = f"Error during API execution: {e}"
@@ -141,7 +962,115 @@ async def run_agent_sync(
         return (
             "I'm having trouble connecting to my internal tools. Try asking me a simple question without code!",
             [],
+            False,
+        )
+
+
+# Shared Agent Zero calls for identical context-free requests: key -> [task, waiter count]
+inflight_requests = {}
+
+
+def request_key(prompt, is_scheduled, attachments):
+    attachments_hash = hashlib.sha256(
+        json.dumps(attachments or [], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return (prompt, attachments_hash, bool(is_scheduled))
+
+
+async def run_agent_coalesced(
+    prompt, is_scheduled=False, screenshot_path=None, attachments=None, session_id=None
+):
+    """Runs run_agent_sync, sharing one call between identical requests already in flight.
+
+    Only context-free requests are coalesced, a request continuing a session always
+    gets its own call.
+    """
+    if (session_id or context_id) and not is_scheduled:
+        return await run_agent_sync(
+            prompt, is_scheduled, screenshot_path, attachments, session_id
+        )
+    key = request_key(prompt, is_scheduled, attachments)
+    entry = inflight_requests.get(key)
+    # Never join a shared call that is already finishing or being cancelled
+    if entry is not None and (entry[0].done() or entry[0].cancelling()):
+        entry = None
+    if entry is None:
+        task = asyncio.create_task(
+            run_agent_sync(prompt, is_scheduled, screenshot_path, attachments)
+        )
+        entry = inflight_requests[key] = [task, 0]
+        task.add_done_callback(
+            lambda done: inflight_requests.pop(key, None)
+            if inflight_requests.get(key, [None])[0] is done
+            else None
         )
+    else:
+        logging.info(f"Coalescing with in-flight request: {prompt}")
+    entry[1] += 1
+    try:
+        # Shield the shared call so one cancelled waiter does not cancel it for the others
+        return await asyncio.shield(entry[0])
+    except asyncio.CancelledError:
+        if entry[1] == 1:
+            # Forget the call first so a new identical request starts a fresh one
+            if inflight_requests.get(key) is entry:
+                inflight_requests.pop(key, None)
+            entry[0].cancel()
+        raise
+    finally:
+        entry[1] -= 1
+
+
+last_update_id = None
+
+
+def load_last_update_id():
+    """Loads the last handled update_id saved by the previous run."""
+    global last_update_id
+    try:
+        with open(UPDATE_STATE_PATH, "r", encoding="utf-8") as f:
+            last_update_id = json.load(f)["update_id"]
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.error(f"Failed to read {UPDATE_STATE_PATH}: {e}")
+
+
+def save_last_update_id(update_id):
+    tmp_path = f"{UPDATE_STATE_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"update_id": update_id}, f)
+    os.replace(tmp_path, UPDATE_STATE_PATH)
+
+
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stops updates that Telegram redelivers after a crash left their offset unconfirmed."""
+    update_id = update.update_id
+    # Update IDs increase one by one. After a week without updates Telegram may start from
+    # a random lower value, so only IDs just below the last handled one count as redeliveries.
+    if (
+        last_update_id is not None
+        and last_update_id - UPDATE_ID_WINDOW < update_id <= last_update_id
+    ):
+        logging.info(f"Ignoring redelivered update {update_id}")
+        raise ApplicationHandlerStop
+
+
+async def mark_update_handled(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Records an update as handled once its handlers ran.
+
+    Runs after the regular handlers, so any agent task it started is already checkpointed
+    and a redelivery after a crash can safely be dropped.
+    """
+    global last_update_id
+    # Unauthorized updates are ignored anyway, no need to write anything for them
+    if update.effective_user is None or update.effective_user.id != MY_ID:
+        return
+    last_update_id = update.update_id
+    try:
+        await asyncio.to_thread(save_last_update_id, update.update_id)
+    except OSError as e:
+        logging.error(f"Failed to save last update_id: {e}")
 
 
 async def process_agent_task(
@@ -150,6 +1079,7 @@ async def process_agent_task(
     context: ContextTypes.DEFAULT_TYPE,
     is_scheduled: bool = False,
     attachments: list = None,
+    session_id: str = None,
 ):
     prefix = "⏰ Scheduled Task" if is_scheduled else "🚀 Task"
     await context.bot.send_message(
@@ -157,10 +1087,26 @@ async def process_agent_task(
     )
     try:
         screenshot_path = f"action_{chat_id}.png"
+        started = time.monotonic()
         # FIX: Await the async function directly instead of using to_thread
-        result, downloaded_images = await run_agent_sync(
-            prompt, is_scheduled, screenshot_path, attachments
+        result, downloaded_images, ok = await run_agent_coalesced(
+            prompt, is_scheduled, screenshot_path, attachments, session_id
         )
+        duration = time.monotonic() - started
+        # Record real answers so they can be found later with /history and /search
+        if ok:
+            try:
+                await asyncio.to_thread(
+                    history_store.add,
+                    chat_id,
+                    prompt,
+                    result,
+                    downloaded_images,
+                    duration,
+                    is_scheduled,
+                )
+            except Exception as e:
+                logging.error(f"Failed to store task result in history: {e}")
         # Send the text response
         await context.bot.send_message(
             chat_id=chat_id, text=f"✅ {prefix} Completed!\n\nResponse:\n{result}"
@@ -207,6 +1153,7 @@ async def process_agent_task(
         )
 
 
+@profiler.timed("handle_request")
 async def handle_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Security check: Only allow the authorized user
     if update.message.from_user.id != MY_ID:
@@ -236,9 +1183,15 @@ async def handle_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         return
     # Process the task asynchronously
-    asyncio.create_task(process_agent_task(user_query, chat_id, context))
+    if not shutdown_coordinator.start_task(user_query, chat_id, context):
+        if RESUME_INTERRUPTED_TASKS:
+            notice = "♻️ Bot is restarting. Your request was saved and will run after the restart."
+        else:
+            notice = "♻️ Bot is restarting. Please send your request again once it is back."
+        await update.message.reply_text(notice)
 
 
+@profiler.timed("handle_photo")
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles incoming photos and saves them with their caption or a default name."""
     if update.message.from_user.id != MY_ID:
@@ -275,22 +1228,29 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if update.message.caption
             else "Please analyze this image."
         )
-        asyncio.create_task(
-            process_agent_task(
-                prompt, update.message.chat_id, context, attachments=attachments
-            )
-        )
+        if not shutdown_coordinator.start_task(
+            prompt, update.message.chat_id, context, attachments=attachments
+        ):
+            if RESUME_INTERRUPTED_TASKS:
+                notice = "♻️ Bot is restarting. Your photo was saved and will be analyzed after the restart."
+            else:
+                notice = "♻️ Bot is restarting. Your photo was saved, send it again once the bot is back to have it analyzed."
+            await update.message.reply_text(notice)
     except Exception as e:
         logging.error(f"Error sending photo to Agent Zero: {e}")
         await update.message.reply_text(f"❌ Error sending photo to Agent Zero: {e}")
 
 
+@profiler.timed("scheduled_job")
 async def scheduled_job(context: ContextTypes.DEFAULT_TYPE):
     """The job that runs on a schedule."""
     job = context.job
     prompt = job.data["prompt"]
     chat_id = job.data["chat_id"]
-    await process_agent_task(prompt, chat_id, context, is_scheduled=True)
+    task = shutdown_coordinator.start_task(prompt, chat_id, context, is_scheduled=True)
+    if task:
+        # asyncio.wait does not raise if the task is cancelled by a shutdown
+        await asyncio.wait([task])
 
 
 async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -411,6 +1371,98 @@ async def restart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Command to show recent task results. Usage: /history [count]"""
+    if update.message.from_user.id != MY_ID:
+        return
+    logging.info(f"📜 COMMAND [History] from {update.message.from_user.first_name}")
+    try:
+        limit = int(context.args[0]) if context.args else 5
+    except ValueError:
+        await update.message.reply_text("Usage: /history [count]")
+        return
+    limit = max(1, min(limit, 20))
+    entries = await asyncio.to_thread(
+        history_store.recent, update.message.chat_id, limit
+    )
+    if not entries:
+        await update.message.reply_text("No history yet.")
+        return
+    text = f"📚 Last {len(entries)} results:\n\n"
+    text += "\n".join(format_history_entry(entry) for entry in entries)
+    await update.message.reply_text(text[:4096])
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Command to search past task results. Usage: /search <terms>"""
+    if update.message.from_user.id != MY_ID:
+        return
+    logging.info(
+        f"📜 COMMAND [Search] from {update.message.from_user.first_name}: {update.message.text}"
+    )
+    terms = " ".join(context.args or [])
+    if not terms:
+        await update.message.reply_text("Usage: /search <terms>")
+        return
+    entries = await asyncio.to_thread(
+        history_store.search, update.message.chat_id, terms
+    )
+    if not entries:
+        await update.message.reply_text(f"🔍 No results found for '{terms}'.")
+        return
+    text = f"🔍 {len(entries)} results for '{terms}':\n\n"
+    text += "\n".join(format_history_entry(entry) for entry in entries)
+    await update.message.reply_text(text[:4096])
+
+
+async def send_profile(chat_id, seconds, context: ContextTypes.DEFAULT_TYPE):
+    """Captures a stack profile in the background and sends the file to the chat."""
+    try:
+        path = await profiler.capture(seconds)
+        with open(path, "rb") as doc:
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=doc,
+                caption=f"🔥 {seconds:g}s profile (folded stacks, open with speedscope or flamegraph.pl)",
+            )
+    except Exception as e:
+        logging.error(f"Profile capture failed: {e}")
+        await context.bot.send_message(
+            chat_id=chat_id, text=f"❌ Profile capture failed: {e}"
+        )
+
+
+async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Command to inspect the running bot. Usage: /debug [stats|tasks|profile <duration>]"""
+    if update.message.from_user.id != MY_ID:
+        return
+    logging.info(
+        f"📜 COMMAND [Debug] from {update.message.from_user.first_name}: {update.message.text}"
+    )
+    action = context.args[0].lower() if context.args else "stats"
+    if action == "stats":
+        await update.message.reply_text(profiler.format_stats())
+    elif action == "tasks":
+        await update.message.reply_text(format_pending_tasks()[:4096])
+    elif action == "profile":
+        try:
+            seconds = parse_duration(context.args[1]) if len(context.args) > 1 else 30
+        except ValueError:
+            await update.message.reply_text("Usage: /debug profile <duration, e.g. 30s>")
+            return
+        if profiler.capturing:
+            await update.message.reply_text("❌ A profile capture is already running.")
+            return
+        seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+        await update.message.reply_text(f"🔥 Capturing a {seconds:g}s profile...")
+        # Capture in the background so other updates keep being processed
+        asyncio.create_task(send_profile(update.message.chat_id, seconds, context))
+    else:
+        await update.message.reply_text(
+            "Usage: /debug [stats|tasks|profile <duration>]"
+        )
+
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Command to show all available features and commands."""
     if update.message.from_user.id != MY_ID:
@@ -428,6 +1480,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "  _Example: /schedule btc 600 Check the price of Bitcoin_\n"
         "/stopschedule \\[name\\] \\- Stop a specific schedule by name, or all if no name provided\\.\n"
         "/schedules \\- List all running schedules\\.\n"
+        "/history \\[count\\] \\- Show your most recent task results\\.\n"
+        "/search \\<terms\\> \\- Search past prompts and responses without re\\-running Agent Zero\\.\n"
+        "/debug \\[stats\\|tasks\\|profile \\<duration\\>\\] \\- Show timings, pending tasks or capture a profile\\.\n"
         "/help \\- Show this information\\.\n\n"
         "*Features:*\n"
         "• *Chatting:* Simply send any text message to get a response from Agent Zero\\.\n"
@@ -438,9 +1493,55 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text, parse_mode="MarkdownV2")
 
 
+async def graceful_shutdown(application):
+    """Drains in-flight tasks before letting the application stop."""
+    logging.info("Stop signal received. Draining in-flight tasks before stopping...")
+    await shutdown_coordinator.shutdown()
+    application.stop_running()
+
+
+async def post_init(application):
+    cleanup_temp_files()
+    load_last_update_id()
+    # Replace the default stop signal handlers so tasks are drained before Application.stop()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(
+                sig, lambda: asyncio.create_task(graceful_shutdown(application))
+            )
+        except (NotImplementedError, RuntimeError):
+            # Not supported on Windows; post_stop still drains on KeyboardInterrupt
+            logging.warning("Could not install graceful shutdown signal handlers.")
+            break
+    backend_pool.start_health_checks()
+    profiler.start()
+    await shutdown_coordinator.resume(application)
+
+
+async def post_stop(application):
+    # No-op if graceful_shutdown already ran
+    await shutdown_coordinator.shutdown()
+    await backend_pool.stop_health_checks()
+    await profiler.stop()
+
+
+async def post_shutdown(application):
+    history_store.close()
+
+
 def create_app():
     # Build the Telegram Application
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    # Drop redelivered updates before any other handler sees them
+    application.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
     # Handle text messages (excluding commands)
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_request)
@@ -455,8 +1556,15 @@ def create_app():
     application.add_handler(CommandHandler("new", new_command))
     application.add_handler(CommandHandler("stop", stop_command))
     application.add_handler(CommandHandler("restart", restart_command))
+    # Handle result history commands
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("search", search_command))
+    # Handle the debug/profiling command
+    application.add_handler(CommandHandler("debug", debug_command))
     # Handle the help command
     application.add_handler(CommandHandler("help", help_command))
+    # Remember the update as handled after the handlers above have run
+    application.add_handler(TypeHandler(Update, mark_update_handled), group=1)
     return application
 
 def main():
@@ -45,4 +45,5 @@ pip install -r requirements.txt
 
 echo "🤖 Starting the Telegram Bot..."
 export ENVIRONMENT=prod
-python agent_zero_telegram_bot.py
+# exec so stop signals reach the bot and in-flight tasks can be drained
+exec python agent_zero_telegram_bot.py
@@ -1,5 +1,8 @@
 import pytest
 import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import AsyncMock, MagicMock, patch
 from telegram import Update, Message, User, Chat
 from telegram.ext import ContextTypes
@@ -31,6 +34,20 @@ def mock_context():
     context.job_queue.jobs = MagicMock()
     return context
 
+@pytest.fixture(autouse=True)
+def history_store(tmp_path):
+    # Keep every test on its own throwaway history database
+    store = bot.HistoryStore(str(tmp_path / "history.db"))
+    with patch('agent_zero_telegram_bot.history_store', store):
+        yield store
+    store.close()
+
+@pytest.fixture(autouse=True)
+def shutdown_coordinator(tmp_path):
+    coordinator = bot.ShutdownCoordinator(str(tmp_path / "pending_tasks.json"), drain_seconds=0.1)
+    with patch('agent_zero_telegram_bot.shutdown_coordinator', coordinator):
+        yield coordinator
+
 async def run_and_await_tasks(coro):
     """Helper to run a coroutine and await any asyncio tasks it creates."""
     original_create_task = asyncio.create_task
@@ -279,3 +296,514 @@ async def test_get_pic_command(mock_update, mock_context, tmp_path):
     caption = kwargs.get('caption', '')
     print(f"\n[TEST] Received photo with caption: '{caption}'")
     assert f"Here is {test_image_name}" in caption
+
+@pytest.mark.asyncio
+@patch('agent_zero_telegram_bot.requests.post')
+async def test_task_result_is_recorded_in_history(mock_post, mock_update, mock_context, history_store):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"response": "Bitcoin is at 100k"}
+    mock_post.return_value = mock_response
+
+    mock_update.message.text = "Check the price of Bitcoin"
+    await run_and_await_tasks(bot.handle_request(mock_update, mock_context))
+
+    entries = history_store.recent(mock_update.message.chat_id)
+    assert len(entries) == 1
+    assert entries[0]["prompt"] == "Check the price of Bitcoin"
+    assert entries[0]["response"] == "Bitcoin is at 100k"
+
+@pytest.mark.asyncio
+@patch('agent_zero_telegram_bot.requests.post')
+async def test_failed_task_is_not_recorded_in_history(mock_post, mock_update, mock_context, history_store):
+    mock_response = MagicMock()
+    mock_response.status_code = 500
+    mock_response.text = "boom"
+    mock_post.return_value = mock_response
+
+    mock_update.message.text = "Check the price of BTC"
+    await run_and_await_tasks(bot.handle_request(mock_update, mock_context))
+
+    args, kwargs = mock_context.bot.send_message.call_args
+    assert "API Error 500" in kwargs.get('text', '')
+    assert history_store.recent(mock_update.message.chat_id) == []
+    assert history_store.search(mock_update.message.chat_id, "BTC") == []
+
+@pytest.mark.asyncio
+async def test_search_command(mock_update, mock_context, history_store):
+    chat_id = mock_update.message.chat_id
+    history_store.add(chat_id, "Check the price of Bitcoin", "Bitcoin is at 100k")
+    history_store.add(chat_id, "Weather in New York", "Sunny and 25C")
+    history_store.add(999, "Bitcoin in another chat", "Not visible here")
+
+    mock_update.message.text = "/search bitcoin"
+    mock_context.args = ["bitcoin"]
+    await run_and_await_tasks(bot.search_command(mock_update, mock_context))
+
+    args, kwargs = mock_update.message.reply_text.call_args
+    response_text = kwargs.get('text', args[0] if args else '')
+    print(f"\n[TEST] Received response:\n{response_text}")
+    assert "Bitcoin is at 100k" in response_text
+    assert "Sunny" not in response_text
+    assert "Not visible here" not in response_text
+
+@pytest.mark.asyncio
+async def test_history_command(mock_update, mock_context, history_store):
+    history_store.add(mock_update.message.chat_id, "Hello", "Hi there", images=["pic/chart.png"])
+    mock_update.message.text = "/history"
+    mock_context.args = []
+    await run_and_await_tasks(bot.history_command(mock_update, mock_context))
+
+    args, kwargs = mock_update.message.reply_text.call_args
+    response_text = kwargs.get('text', args[0] if args else '')
+    print(f"\n[TEST] Received response:\n{response_text}")
+    assert "Hi there" in response_text
+    assert "chart.png" in response_text
+
+def test_history_retention_and_compaction(tmp_path):
+    store = bot.HistoryStore(str(tmp_path / "bounded.db"), max_entries_per_chat=3, max_db_bytes=0)
+    for i in range(5):
+        store.add(1, f"prompt {i}", f"response {i}")
+    assert [e["prompt"] for e in store.recent(1, 10)] == ["prompt 4", "prompt 3", "prompt 2"]
+    assert store.search(1, "prompt 0") == []
+
+    store.max_entries_per_chat = 0
+    store.max_db_bytes = 64 * 1024
+    for i in range(200):
+        store.add(2, f"prompt {i}", "x" * 2000)
+    assert store._db_size(store._connect()) <= store.max_db_bytes
+    assert len(store.recent(2, 1000)) < 200
+    store.close()
+
+@pytest.mark.asyncio
+async def test_shutdown_checkpoints_unfinished_tasks(mock_context, shutdown_coordinator, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "action_12345.png").write_bytes(b"stale screenshot")
+
+    async def slow_agent(*args, **kwargs):
+        await asyncio.sleep(10)
+        return "never", [], False
+
+    with patch('agent_zero_telegram_bot.run_agent_sync', side_effect=slow_agent):
+        task = shutdown_coordinator.start_task("Long research task", 12345, mock_context)
+        await asyncio.sleep(0)
+        await shutdown_coordinator.shutdown()
+
+    assert task.cancelled()
+    assert shutdown_coordinator.in_flight == 0
+    assert not (tmp_path / "action_12345.png").exists()
+    records = shutdown_coordinator._load_checkpoint()
+    assert [r["prompt"] for r in records] == ["Long research task"]
+    assert records[0]["chat_id"] == 12345
+
+def test_shutdown_is_not_held_up_by_hanging_backend(mock_context, shutdown_coordinator, tmp_path, monkeypatch):
+    import time
+    monkeypatch.chdir(tmp_path)
+    hang = threading.Event()
+
+    def hanging_post(url, **kwargs):
+        hang.wait(10)
+        raise bot.requests.ConnectionError("released")
+
+    async def scenario():
+        task = shutdown_coordinator.start_task("Hanging task", 12345, mock_context)
+        await asyncio.sleep(0.05)
+        await shutdown_coordinator.shutdown()
+        assert task.cancelled()
+
+    started = time.monotonic()
+    try:
+        with patch('agent_zero_telegram_bot.requests.post', side_effect=hanging_post):
+            # asyncio.run also closes the loop and waits for the default executor
+            asyncio.run(scenario())
+        elapsed = time.monotonic() - started
+    finally:
+        hang.set()
+
+    assert elapsed < shutdown_coordinator.drain_seconds + 1
+    assert [r["prompt"] for r in shutdown_coordinator._load_checkpoint()] == ["Hanging task"]
+
+@pytest.mark.asyncio
+@patch('agent_zero_telegram_bot.requests.post')
+async def test_shutdown_drains_finished_tasks(mock_post, mock_context, shutdown_coordinator):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"response": "Done"}
+    mock_post.return_value = mock_response
+
+    shutdown_coordinator.drain_seconds = 5
+    task = shutdown_coordinator.start_task("Quick task", 12345, mock_context)
+    await shutdown_coordinator.shutdown()
+
+    assert task.done() and not task.cancelled()
+    assert shutdown_coordinator._load_checkpoint() == []
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("resume, expected", [(True, "will run after the restart"), (False, "send your request again")])
+async def test_request_during_shutdown_is_deferred(resume, expected, mock_update, mock_context, shutdown_coordinator):
+    await shutdown_coordinator.shutdown()
+    mock_update.message.text = "Hello after stop"
+
+    with patch('agent_zero_telegram_bot.RESUME_INTERRUPTED_TASKS', resume):
+        created_tasks = await run_and_await_tasks(bot.handle_request(mock_update, mock_context))
+
+    assert len(created_tasks) == 0
+    mock_update.message.reply_text.assert_awaited_once()
+    args, kwargs = mock_update.message.reply_text.call_args
+    print(f"\n[TEST] Received response: '{args[0]}'")
+    assert expected in args[0]
+    assert [r["prompt"] for r in shutdown_coordinator._load_checkpoint()] == ["Hello after stop"]
+
+@pytest.mark.asyncio
+@patch('agent_zero_telegram_bot.requests.post')
+async def test_resume_interrupted_tasks(mock_post, mock_context, shutdown_coordinator):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"response": "Resumed answer", "context_id": "ctx-1"}
+    mock_post.return_value = mock_response
+    shutdown_coordinator._append_checkpoint([{
+        "prompt": "Interrupted task", "chat_id": 12345, "is_scheduled": False,
+        "attachments": [], "context_id": "ctx-1", "created_at": 0,
+    }])
+    application = MagicMock()
+    application.bot = mock_context.bot
+
+    try:
+        await run_and_await_tasks(shutdown_coordinator.resume(application))
+        payload = mock_post.call_args.kwargs["json"]
+        assert payload["message"] == "Interrupted task"
+        assert payload["context_id"] == "ctx-1"
+    finally:
+        bot.reset_session()
+
+    texts = [call.kwargs.get("text", "") for call in mock_context.bot.send_message.call_args_list]
+    print("\n[TEST] Received messages from bot:")
+    for text in texts:
+        print(f"  -> {text}")
+    assert any("Resuming" in text for text in texts)
+    assert any("Resumed answer" in text for text in texts)
+    assert not bot.os.path.exists(shutdown_coordinator.checkpoint_path)
+
+
+@pytest.mark.asyncio
+async def test_resume_keeps_each_task_on_its_own_context(mock_context, shutdown_coordinator):
+    payloads = []
+
+    def post(url, **kwargs):
+        payloads.append(kwargs["json"])
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = {"response": "ok", "context_id": kwargs["json"].get("context_id")}
+        return response
+
+    shutdown_coordinator._append_checkpoint([
+        {"prompt": "First", "chat_id": 1, "is_scheduled": False, "attachments": [], "context_id": "ctx-1", "created_at": 0},
+        {"prompt": "Second", "chat_id": 2, "is_scheduled": False, "attachments": [], "context_id": "ctx-2", "created_at": 0},
+    ])
+    application = MagicMock()
+    application.bot = mock_context.bot
+
+    async def slow_send(**kwargs):
+        # Yield so the first resumed task runs while the second record is being handled
+        await asyncio.sleep(0.05)
+
+    mock_context.bot.send_message.side_effect = slow_send
+    try:
+        with patch('agent_zero_telegram_bot.requests.post', side_effect=post):
+            await run_and_await_tasks(shutdown_coordinator.resume(application))
+    finally:
+        bot.reset_session()
+
+    assert {p["message"]: p["context_id"] for p in payloads} == {"First": "ctx-1", "Second": "ctx-2"}
+
+@pytest.mark.asyncio
+async def test_resume_keeps_records_that_could_not_be_resumed(mock_context, shutdown_coordinator):
+    shutdown_coordinator._append_checkpoint([
+        {"prompt": "Blocked chat", "chat_id": 1, "is_scheduled": True, "attachments": [], "context_id": None, "created_at": 0},
+        {"prompt": "Fine chat", "chat_id": 2, "is_scheduled": True, "attachments": [], "context_id": None, "created_at": 0},
+    ])
+    application = MagicMock()
+    application.bot = mock_context.bot
+
+    async def send(chat_id, text):
+        if chat_id == 1:
+            raise RuntimeError("Forbidden: bot was blocked by the user")
+
+    mock_context.bot.send_message.side_effect = send
+    with patch('agent_zero_telegram_bot.run_agent_sync', new=AsyncMock(return_value=("ok", [], True))):
+        await run_and_await_tasks(shutdown_coordinator.resume(application))
+
+    assert [r["prompt"] for r in shutdown_coordinator._load_checkpoint()] == ["Blocked chat"]
+
+class StandInAgentZero:
+    """Minimal local Agent Zero stand-in answering /api_message and /health."""
+
+    def __init__(self, name):
+        self.name = name
+        self.healthy = True
+        self.messages = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._reply(200 if stand_in.healthy else 503, {"ok": stand_in.healthy})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stand_in.messages.append(payload)
+                context = payload.get("context_id") or f"ctx-{stand_in.name}-{len(stand_in.messages)}"
+                self._reply(200, {"response": f"answer from {stand_in.name}", "context_id": context})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def stand_ins():
+    servers = [StandInAgentZero("a"), StandInAgentZero("b")]
+    yield servers
+    for server in servers:
+        server.close()
+
+@pytest.mark.asyncio
+async def test_backend_pool_sticky_sessions(stand_ins):
+    pool = bot.BackendPool([s.url for s in stand_ins], ["key"])
+    with patch('agent_zero_telegram_bot.backend_pool', pool):
+        try:
+            await bot.run_agent_sync("Hello")
+            owner = next(s for s in stand_ins if s.messages)
+            for _ in range(3):
+                result, _, _ = await bot.run_agent_sync("Follow up")
+                assert result == f"answer from {owner.name}"
+        finally:
+            bot.reset_session()
+    assert len(owner.messages) == 4
+    assert all(m["context_id"] == f"ctx-{owner.name}-1" for m in owner.messages[1:])
+    assert sum(len(s.messages) for s in stand_ins) == 4
+
+def test_backend_pool_least_outstanding():
+    pool = bot.BackendPool(["http://a0-one:5000", "http://a0-two:5000"], ["key"])
+    pool.backends[0].outstanding = 3
+    assert pool.acquire() is pool.backends[1]
+    pool.backends[1].outstanding = 5
+    assert pool.acquire() is pool.backends[0]
+
+@pytest.mark.asyncio
+async def test_backend_pool_failover_without_session(stand_ins):
+    down = stand_ins[0]
+    down.close()
+    pool = bot.BackendPool([s.url for s in stand_ins], ["key"])
+    with patch('agent_zero_telegram_bot.backend_pool', pool):
+        for _ in range(3):
+            result, _, _ = await bot.run_agent_sync("Scheduled check", is_scheduled=True)
+            assert result == "answer from b"
+    assert not pool.backends[0].healthy
+    assert len(stand_ins[1].messages) == 3
+
+@pytest.mark.asyncio
+async def test_backend_pool_health_checks(stand_ins):
+    stand_ins[0].healthy = False
+    pool = bot.BackendPool([s.url for s in stand_ins], ["key"])
+    await pool.check_health()
+    assert [b.healthy for b in pool.backends] == [False, True]
+    assert all(pool.acquire() is pool.backends[1] for _ in range(4))
+
+    stand_ins[0].healthy = True
+    await pool.check_health()
+    assert all(b.healthy for b in pool.backends)
+
+@pytest.mark.asyncio
+async def test_identical_requests_are_coalesced(mock_context):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_post(url, **kwargs):
+        started.set()
+        release.wait(5)
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = {"response": "Shared answer"}
+        return response
+
+    with patch('agent_zero_telegram_bot.requests.post', side_effect=slow_post) as mock_post:
+        first = asyncio.create_task(bot.process_agent_task("Check BTC", 111, mock_context, is_scheduled=True))
+        await asyncio.to_thread(started.wait, 5)
+        second = asyncio.create_task(bot.process_agent_task("Check BTC", 222, mock_context, is_scheduled=True))
+        other = asyncio.create_task(bot.process_agent_task("Check ETH", 222, mock_context, is_scheduled=True))
+        await asyncio.sleep(0.1)
+        release.set()
+        await asyncio.gather(first, second, other)
+
+    assert mock_post.call_count == 2
+    assert bot.inflight_requests == {}
+    completed = [call.kwargs for call in mock_context.bot.send_message.call_args_list if "Shared answer" in call.kwargs["text"]]
+    assert sorted(kwargs["chat_id"] for kwargs in completed) == [111, 222, 222]
+
+@pytest.mark.asyncio
+async def test_request_after_cancelled_shared_call_starts_fresh():
+    calls = []
+
+    async def agent(prompt, *args):
+        calls.append(prompt)
+        await asyncio.sleep(0.05)
+        return "fresh", [], True
+
+    with patch('agent_zero_telegram_bot.run_agent_sync', side_effect=agent):
+        first = asyncio.create_task(bot.run_agent_coalesced("X", True))
+        await asyncio.sleep(0)
+        first.cancel()
+        # Let the waiter handle its cancellation, but not the shared call finish cancelling
+        await asyncio.sleep(0)
+        result = await bot.run_agent_coalesced("X", True)
+
+    assert first.cancelled()
+    assert result == ("fresh", [], True)
+    assert len(calls) == 2
+    assert bot.inflight_requests == {}
+
+@pytest.mark.asyncio
+async def test_session_requests_are_not_coalesced():
+    with patch('agent_zero_telegram_bot.context_id', "ctx-1"), \
+         patch('agent_zero_telegram_bot.run_agent_sync', new=AsyncMock(return_value=("ok", [], True))) as mock_run:
+        await asyncio.gather(bot.run_agent_coalesced("Same"), bot.run_agent_coalesced("Same"))
+    assert mock_run.await_count == 2
+
+@pytest.mark.asyncio
+async def test_updates_redelivered_after_restart_are_dropped(mock_update, mock_context, tmp_path):
+    mock_update.effective_user = mock_update.message.from_user
+    with patch('agent_zero_telegram_bot.UPDATE_STATE_PATH', str(tmp_path / "last_update_id.json")), \
+         patch('agent_zero_telegram_bot.last_update_id', None):
+        mock_update.update_id = 424242
+        await bot.drop_duplicate_updates(mock_update, mock_context)
+        await bot.mark_update_handled(mock_update, mock_context)
+
+        # Simulate a crash: the in-memory state is gone, only the file survives
+        bot.last_update_id = None
+        bot.load_last_update_id()
+        assert bot.last_update_id == 424242
+        with pytest.raises(bot.ApplicationHandlerStop):
+            await bot.drop_duplicate_updates(mock_update, mock_context)
+
+        mock_update.update_id = 424243
+        await bot.drop_duplicate_updates(mock_update, mock_context)
+        # Telegram restarts the sequence at a random value after a week without updates
+        mock_update.update_id = 1000
+        await bot.drop_duplicate_updates(mock_update, mock_context)
+
+        # Updates from other users are not recorded
+        mock_update.effective_user = MagicMock(id=999999)
+        await bot.mark_update_handled(mock_update, mock_context)
+        assert bot.last_update_id == 424242
+
+@pytest.mark.asyncio
+async def test_started_task_is_checkpointed_before_it_runs(mock_context, shutdown_coordinator):
+    release = asyncio.Event()
+
+    async def agent(*args, **kwargs):
+        await release.wait()
+        return "ok", [], True
+
+    with patch('agent_zero_telegram_bot.run_agent_sync', side_effect=agent):
+        task = shutdown_coordinator.start_task("Crash-safe task", 12345, mock_context)
+        # A crash at this point leaves the record for the next start to resume
+        assert [r["prompt"] for r in shutdown_coordinator._load_checkpoint()] == ["Crash-safe task"]
+        release.set()
+        await task
+        await asyncio.sleep(0)
+
+    assert shutdown_coordinator._load_checkpoint() == []
+
+@pytest.mark.asyncio
+async def test_profiler_records_sampled_handler_timings(mock_update, mock_context):
+    mock_update.message.text = "Hello"
+    mock_update.message.from_user.id = 999999
+    with patch.object(bot.profiler, 'enabled', True), \
+         patch.object(bot.profiler, 'sample_rate', 1.0), \
+         patch.object(bot.profiler, 'timings', {}):
+        await bot.handle_request(mock_update, mock_context)
+        stats = bot.profiler.format_stats()
+        assert bot.profiler.timings["handle_request"]["count"] == 1
+    print(f"\n[TEST] Profiler stats:\n{stats}")
+    assert "handle_request: 1 samples" in stats
+
+@pytest.mark.asyncio
+async def test_profiler_logs_stack_of_blocking_callback(caplog):
+    import time
+
+    def blocking_handler():
+        time.sleep(0.5)
+
+    profiler = bot.Profiler(enabled=True, sample_rate=1.0)
+    with patch('agent_zero_telegram_bot.LOOP_LAG_INTERVAL', 0.05), \
+         patch('agent_zero_telegram_bot.SLOW_CALLBACK_SECONDS', 0.1):
+        profiler.start()
+        try:
+            await asyncio.sleep(0.1)
+            blocking_handler()
+            await asyncio.sleep(0.1)
+        finally:
+            await profiler.stop()
+
+    assert not asyncio.get_running_loop().get_debug()
+    assert profiler.loop_lag_max >= 0.3
+    blocked = [r.getMessage() for r in caplog.records if "Event loop blocked" in r.getMessage()]
+    assert len(blocked) == 1
+    assert "blocking_handler" in blocked[0]
+
+@pytest.mark.asyncio
+async def test_debug_tasks_command(mock_update, mock_context, shutdown_coordinator):
+    async def slow_agent(*args, **kwargs):
+        await asyncio.sleep(10)
+        return "never", [], False
+
+    mock_update.message.text = "/debug tasks"
+    mock_context.args = ["tasks"]
+    with patch('agent_zero_telegram_bot.run_agent_sync', side_effect=slow_agent):
+        task = shutdown_coordinator.start_task("Stuck task", 12345, mock_context)
+        await asyncio.sleep(0)
+        await bot.debug_command(mock_update, mock_context)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    args, kwargs = mock_update.message.reply_text.call_args
+    response_text = kwargs.get('text', args[0] if args else '')
+    print(f"\n[TEST] Received response:\n{response_text}")
+    assert "process_agent_task" in response_text
+    assert "Stuck task" in response_text
+
+@pytest.mark.asyncio
+async def test_debug_profile_command(mock_update, mock_context, tmp_path):
+    mock_update.message.text = "/debug profile 1s"
+    mock_context.args = ["profile", "1s"]
+    with patch('agent_zero_telegram_bot.PROFILE_DIR', str(tmp_path)):
+        await run_and_await_tasks(bot.debug_command(mock_update, mock_context))
+
+    mock_context.bot.send_document.assert_awaited_once()
+    profiles = list(tmp_path.glob("*.folded"))
+    assert len(profiles) == 1
+    lines = profiles[0].read_text().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert ";" in stack and int(count) > 0
+
+def test_parse_duration():
+    assert bot.parse_duration("30s") == 30
+    assert bot.parse_duration("2m") == 120
+    assert bot.parse_duration("15") == 15
+    with pytest.raises(ValueError):
+        bot.parse_duration("soon")